@@ -4,23 +4,51 @@ Local Gemma 3n E4B model server for Gemini CLI integration.
 Provides REST API endpoints that mimic Google's Gemini API format.
 """
 
+import base64
+import numpy as np
 import torch
+import torch.nn.functional as F
 import uvicorn
 import warnings
 import os
+import orjson
+import asyncio
+import copy
+import functools
+import threading
 from typing import List, Dict, Any, Optional, AsyncGenerator
 from datetime import datetime
+from dataclasses import dataclass, field
 
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from transformers import AutoProcessor, AutoModelForImageTextToText, AutoTokenizer
+from transformers import (AutoProcessor, AutoModelForImageTextToText,
+                          AutoTokenizer, StaticCache, TextIteratorStreamer)
+from transformers import GenerationConfig as HFGenerationConfig
 
 warnings.filterwarnings('ignore')
 
 # Enable MPS fallback for unsupported operations
 os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
 
+# Weight-only quantization for the language model linears ("int8", "fp8" or "none")
+WEIGHT_QUANTIZATION = os.environ.get('GEMMA_WEIGHT_QUANT', 'int8').lower()
+
+# Upper bound on maxOutputTokens; the StaticCache for the whole output is
+# allocated up front (about 70 KB per token per request on E4B)
+MAX_NEW_TOKENS = int(os.environ.get('GEMMA_MAX_NEW_TOKENS', '2048'))
+
+# Concurrent generateContent calls arriving within this window share one batch
+MAX_BATCH_SIZE = 8
+BATCH_WINDOW_SECONDS = 0.01
+
+# KV cache lengths are rounded up to this so decode shapes repeat across requests
+CACHE_LENGTH_BUCKET = 256
+
+# Prompt lengths run at startup to warm compiled graphs and shape caches
+WARMUP_SEQUENCE_LENGTHS = (32, 256, 1024, 2048)
+
 # Request/Response Models
 
 
@@ -96,21 +124,124 @@ class CountTokensResponse(BaseModel):
 class EmbedContentRequest(BaseModel):
     contents: List[str]
     model: str
+    encodingFormat: Optional[str] = None  # 'float' (default) or 'base64'
 
 
 class Embedding(BaseModel):
-    values: List[float]
+    values: Optional[List[float]] = None
+    # Little-endian float32 bytes, base64 encoded (encodingFormat='base64')
+    values_b64: Optional[str] = None
 
 
 class EmbedContentResponse(BaseModel):
     embeddings: List[Embedding]
 
 
-# Global model instance
-model = None
-processor = None
-tokenizer = None
-device = None
+class Int8WeightOnlyLinear(torch.nn.Module):
+    """nn.Linear replacement with int8 weights and per-channel scales."""
+
+    # _weight_int8pack_mm crashes on CPU bfloat16 for unaligned in_features
+    # (e.g. 8 or 24); every Gemma 3n projection is a multiple of this
+    FUSED_ALIGNMENT = 32
+
+    def __init__(self, linear: torch.nn.Linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+
+        weight = linear.weight.detach()
+        scale = weight.float().abs().amax(dim=1).clamp(min=1e-8) / 127.0
+        qweight = torch.round(weight.float() / scale[:, None]).clamp(-128, 127)
+        self.register_buffer("weight", qweight.to(torch.int8))
+        self.register_buffer("scale", scale.to(weight.dtype))
+        self.register_buffer(
+            "bias", linear.bias.detach() if linear.bias is not None else None)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if (x.dtype == self.scale.dtype
+                and self.in_features % self.FUSED_ALIGNMENT == 0
+                and hasattr(torch.ops.aten, "_weight_int8pack_mm")):
+            # Fused int8 x half matmul, avoids materialising the dequantized weight
+            out = torch.ops.aten._weight_int8pack_mm(
+                x.reshape(-1, self.in_features).contiguous(), self.weight, self.scale)
+            out = out.reshape(*x.shape[:-1], self.out_features)
+        else:
+            weight = self.weight.to(x.dtype) * self.scale.to(x.dtype)[:, None]
+            out = F.linear(x, weight)
+
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+        return out
+
+
+class Float8WeightOnlyLinear(torch.nn.Module):
+    """nn.Linear replacement with float8 (E4M3) weights and per-channel scales."""
+
+    # Largest finite value representable in float8_e4m3fn
+    FP8_MAX = 448.0
+
+    def __init__(self, linear: torch.nn.Linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+
+        weight = linear.weight.detach()
+        scale = weight.float().abs().amax(dim=1).clamp(min=1e-8) / self.FP8_MAX
+        self.register_buffer(
+            "weight", (weight.float() / scale[:, None]).to(torch.float8_e4m3fn))
+        self.register_buffer("scale", scale.to(weight.dtype))
+        self.register_buffer(
+            "bias", linear.bias.detach() if linear.bias is not None else None)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # The half-precision weight is a per-call temporary; only the fp8
+        # copy stays resident, so compile_model leaves freezing off here
+        weight = self.weight.to(x.dtype) * self.scale.to(x.dtype)[:, None]
+        out = F.linear(x, weight)
+
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+        return out
+
+
+# Linears left in full precision: lm_head for output quality, and the tiny
+# Gemma3n AltUp projections, whose weights AltUp clamps in place every forward
+UNQUANTIZED_LINEARS = {
+    "lm_head",
+    "correction_coefs",
+    "prediction_coefs",
+    "modality_router",
+}
+
+
+def quantize_linear_layers(model, linear_cls) -> int:
+    """Replace the language model's nn.Linear layers with linear_cls."""
+    count = 0
+    for name, module in list(model.named_modules()):
+        # Only the text decoder
+        if "language_model" not in name:
+            continue
+        for child_name, child in list(module.named_children()):
+            if (isinstance(child, torch.nn.Linear)
+                    and child_name not in UNQUANTIZED_LINEARS):
+                setattr(module, child_name, linear_cls(child))
+                count += 1
+    return count
+
+
+@dataclass(eq=False)
+class AppState:
+    """Loaded model components shared by the request handlers."""
+    model: Any
+    processor: Any
+    tokenizer: Any
+    device: torch.device
+    # Token ids of the default system prompt prefix
+    system_ids: Optional[torch.Tensor] = None
+    generation_queue: Optional[asyncio.Queue] = None
+    batch_worker: Optional[asyncio.Task] = None
+    # Serializes model.generate between the batch worker and stream threads
+    generation_lock: threading.Lock = field(default_factory=threading.Lock)
 
 
 def get_device():
@@ -124,13 +255,146 @@ def get_device():
     return device
 
 
-def load_model():
-    """Load the Gemma 3n E4B model."""
-    global model, processor, tokenizer, device
+def get_model_dtype(device):
+    """Get the half-precision dtype to load weights in for a device."""
+    # bfloat16 support on MPS is incomplete, so use float16 there
+    if device.type == "mps":
+        return torch.float16
+    return torch.bfloat16
 
-    if model is not None:
-        return
 
+def get_fallback_dtype(device):
+    """Get the dtype to switch to when float16 activations overflow."""
+    # bfloat16 has float32's range; MPS only supports it from macOS 14
+    try:
+        torch.ones(1, dtype=torch.bfloat16, device=device).sum().item()
+        return torch.bfloat16
+    except (RuntimeError, TypeError):
+        return torch.float32
+
+
+def logits_are_finite(state: AppState) -> bool:
+    """Run the default prompt through the model and check for inf/NaN logits."""
+    inputs = prepare_inputs(state, GenerateContentRequest(
+        contents=[Content(role="user", parts=[Part(text="Hello")])]))
+    inputs = {name: to_device(state, value) for name, value in inputs.items()}
+    with torch.inference_mode():
+        logits = state.model(**inputs, logits_to_keep=1).logits
+    return bool(torch.isfinite(logits).all())
+
+
+def find_decoder_layers(model) -> Optional[torch.nn.ModuleList]:
+    """Locate the repeated decoder blocks of the language model."""
+    # Attribute layout differs between transformers releases
+    for path in ("model.language_model.layers",
+                 "language_model.model.layers",
+                 "model.layers"):
+        module = model
+        for attr in path.split("."):
+            module = getattr(module, attr, None)
+            if module is None:
+                break
+        if isinstance(module, torch.nn.ModuleList):
+            return module
+    return None
+
+
+def compile_model(model, device) -> Optional[List[torch.nn.Module]]:
+    """Compile each decoder block, returning the eager layers (or None)."""
+    if not hasattr(torch, "compile"):
+        return None
+
+    layers = find_decoder_layers(model)
+    if layers is None:
+        print("⚠️ Decoder layers not found, skipping torch.compile")
+        return None
+
+    # Regional compilation: embeddings, vision tower and lm_head stay eager.
+    # Gemma 3n blocks differ (sliding vs full attention, KV sharing), so
+    # Dynamo guards can recompile per layer; give each layer its own budget
+    # instead of falling back to eager once the default limit of 8 is hit.
+    eager_layers = list(layers)
+    try:
+        import torch._dynamo.config as dynamo_config
+        # Older releases only have cache_size_limit; newer alias it
+        for limit in ("recompile_limit", "cache_size_limit"):
+            if hasattr(dynamo_config, limit):
+                setattr(dynamo_config, limit,
+                        max(getattr(dynamo_config, limit), 8 * len(layers)))
+
+        if device.type == "cpu":
+            import torch._inductor.config as inductor_config
+            # Freeze weights into constants so int8 weights are folded at
+            # compile time. Not for fp8: freezing would constant-fold the
+            # dequantized weight into a resident half-precision copy
+            inductor_config.freezing = not any(
+                isinstance(m, Float8WeightOnlyLinear) for m in model.modules())
+            inductor_config.cpp_wrapper = True
+
+        print(f"Compiling {len(layers)} decoder layers with torch.compile...")
+        for i, layer in enumerate(eager_layers):
+            # dynamic=True because prompt length varies per request
+            layers[i] = torch.compile(
+                layer,
+                mode="reduce-overhead",
+                fullgraph=False,
+                dynamic=True,
+            )
+        return eager_layers
+    except Exception as e:
+        print(f"⚠️ torch.compile unavailable, using eager mode: {e}")
+        restore_eager_layers(model, eager_layers)
+        return None
+
+
+def restore_eager_layers(model, eager_layers: List[torch.nn.Module]):
+    """Swap compiled decoder layers back for their eager originals."""
+    layers = find_decoder_layers(model)
+    for i, layer in enumerate(eager_layers):
+        layers[i] = layer
+
+
+def run_warmup(state: AppState, compiled: bool):
+    """Run warmup generations so the first real request hits warm caches."""
+    model, tokenizer, device = state.model, state.tokenizer, state.device
+    warmup_messages = [{
+        "role": "user",
+        "content": [{"type": "text", "text": "Hello"}]
+    }]
+
+    with torch.inference_mode():
+        inputs = state.processor.apply_chat_template(
+            warmup_messages,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_tensors="pt"
+        ).to(device)
+
+        _ = model.generate(
+            inputs,
+            max_new_tokens=10,
+            do_sample=False,
+            use_cache=True,
+        )
+
+        if compiled or device.type == "mps":
+            # Prime compiled graphs and MPS kernel caches for representative
+            # prompt lengths so real requests don't pay the first-shape cost
+            for seq_len in WARMUP_SEQUENCE_LENGTHS:
+                warmup_ids = torch.randint(
+                    0, tokenizer.vocab_size, (1, seq_len), device=device)
+                _ = model.generate(
+                    warmup_ids,
+                    attention_mask=torch.ones_like(warmup_ids),
+                    past_key_values=make_static_cache(state, 1, seq_len + 4),
+                    max_new_tokens=4,
+                    do_sample=False,
+                    use_cache=True,
+                )
+
+
+def load_model() -> AppState:
+    """Load the Gemma 3n E4B model."""
     print("Loading Gemma 3n E4B model...")
     device = get_device()
 
@@ -149,15 +413,33 @@ def load_model():
         # Load model with appropriate settings
         print("Loading model (this may take a few minutes for first-time download)...")
 
-        # Key optimization: Use float32 for MPS stability
+        # Half precision halves the bytes moved per decode step
         model = AutoModelForImageTextToText.from_pretrained(
             model_id,
-            torch_dtype=torch.float32,  # Changed from bfloat16 for MPS
+            torch_dtype=get_model_dtype(device),
             low_cpu_mem_usage=True,
             trust_remote_code=True,
+            # Route attention through F.scaled_dot_product_attention fused kernels
+            attn_implementation="sdpa",
             # Don't use device_map with MPS
         )
 
+        # Quantize before moving to the device so only quantized weights are copied
+        quantization = WEIGHT_QUANTIZATION
+        if quantization == "fp8" and (device.type == "mps"
+                                      or not hasattr(torch, "float8_e4m3fn")):
+            print("⚠️ float8 weights not supported here, using int8 instead")
+            quantization = "int8"
+
+        linear_cls = {
+            "int8": Int8WeightOnlyLinear,
+            "fp8": Float8WeightOnlyLinear,
+        }.get(quantization)
+        if linear_cls is not None:
+            print(f"Quantizing language model linear layers to {quantization}...")
+            count = quantize_linear_layers(model, linear_cls)
+            print(f"✅ Quantized {count} linear layers")
+
         # Explicitly move to MPS after loading
         if device.type == "mps":
             print("Moving model to MPS...")
@@ -169,31 +451,48 @@ def load_model():
         if hasattr(model.config, 'use_cache'):
             model.config.use_cache = True
 
+        # Every generate call brings its own StaticCache; the checkpoint's
+        # "hybrid" cache_implementation default would conflict with it, and
+        # transformers merges model defaults over None in per-call configs
+        model.generation_config.cache_implementation = None
+
+        state = AppState(
+            model=model,
+            processor=processor,
+            tokenizer=tokenizer,
+            device=device,
+        )
+
+        # Tokenize the default system prompt once so requests reuse it
+        state.system_ids = system_prefix_ids(state, _DEFAULT_SYSTEM_PROMPT)
+
+        # Gemma's residual stream and MLP activations can exceed float16's
+        # range; serve in a wider dtype rather than returning NaN logits
+        if model.dtype == torch.float16 and not logits_are_finite(state):
+            fallback_dtype = get_fallback_dtype(device)
+            print(f"⚠️ float16 logits overflowed, switching to {fallback_dtype}")
+            model.to(fallback_dtype)
+
+        eager_layers = compile_model(model, device)
+        compiled = eager_layers is not None
+
         print("✅ Gemma 3n E4B model loaded successfully!")
 
         # Warmup inference for better performance
         print("Running warmup inference...")
-        warmup_messages = [{
-            "role": "user",
-            "content": [{"type": "text", "text": "Hello"}]
-        }]
-
-        with torch.inference_mode():
-            inputs = processor.apply_chat_template(
-                warmup_messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_tensors="pt"
-            ).to(device)
-
-            _ = model.generate(
-                inputs,
-                max_new_tokens=10,
-                do_sample=False,
-                use_cache=True,
-            )
+        try:
+            run_warmup(state, compiled)
+        except Exception as e:
+            if not compiled:
+                raise
+            # Inductor coverage on MPS is still partial; serve eagerly instead
+            print(f"⚠️ Compiled warmup failed ({e}), falling back to eager mode")
+            restore_eager_layers(model, eager_layers)
+            run_warmup(state, False)
         print("✅ Warmup complete!")
 
+        return state
+
     except Exception as e:
         print(f"❌ Error loading model: {e}")
         print("Make sure you have:")
@@ -204,19 +503,30 @@ def load_model():
         raise
 
 
-def estimate_tokens(text: str) -> int:
-    """Rough token estimation (1 token ≈ 4 characters)."""
-    return max(1, len(text) // 4)
-
-
 # FastAPI app
-app = FastAPI(title="Gemma 3n E4B Local Server", version="1.0.0")
+app = FastAPI(
+    title="Gemma 3n E4B Local Server",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 
 @app.on_event("startup")
 async def startup_event():
-    """Load the model on startup."""
-    load_model()
+    """Load the model and start the batching worker on startup."""
+    state = load_model()
+
+    state.generation_queue = asyncio.Queue()
+    state.batch_worker = asyncio.create_task(batch_generation_worker(state))
+    app.state.core = state
+
+
+def get_app_state(request: Request) -> AppState:
+    """Resolve the loaded model state for a request handler."""
+    state = getattr(request.app.state, "core", None)
+    if state is None:
+        raise HTTPException(status_code=500, detail="Model not loaded")
+    return state
 
 
 @app.get("/")
@@ -225,23 +535,8 @@ async def root():
     return {"status": "running", "model": "google/gemma-3n-E4B-it"}
 
 
-@app.post("/v1/models/{model_name}:generateContent")
-async def generate_content(
-    model_name: str,
-    request: GenerateContentRequest
-) -> GenerateContentResponse:
-    """Generate content using the local model."""
-    global model, processor, tokenizer, device
-
-    if model is None or processor is None:
-        raise HTTPException(status_code=500, detail="Model not loaded")
-
-    try:
-        # Convert to proper chat message format
-        messages = []
-
-        # Use the same system prompt as Gemini CLI for consistency
-        system_text = """You are an interactive CLI agent specializing in software engineering tasks. Your primary goal is to help users safely and efficiently, adhering strictly to the following instructions and utilizing your available tools.
+# Use the same system prompt as Gemini CLI for consistency
+_DEFAULT_SYSTEM_PROMPT: str = """You are an interactive CLI agent specializing in software engineering tasks. Your primary goal is to help users safely and efficiently, adhering strictly to the following instructions and utilizing your available tools.
 
 # Core Mandates
 
@@ -271,103 +566,415 @@ async def generate_content(
 - **Explain Critical Commands:** Before executing commands that modify the file system, codebase, or system state, you *must* provide a brief explanation of the command's purpose and potential impact. Prioritize user understanding and safety.
 - **Security First:** Always apply security best practices. Never introduce code that exposes, logs, or commits secrets, API keys, or other sensitive information."""
 
-        if request.systemInstruction:
-            # Use provided system instruction from the CLI
-            for part in request.systemInstruction.parts:
-                if part.text:
-                    system_text = part.text
-                    break
-
-        messages.append({
-            "role": "system",
-            "content": [{"type": "text", "text": system_text}]
-        })
-
-        # Convert request contents to proper message format
-        for content in request.contents:
-            message_content = []
-            for part in content.parts:
-                if part.text:
-                    message_content.append({"type": "text", "text": part.text})
-                elif part.image:
-                    message_content.append(
-                        {"type": "image", "image": part.image})
-
-            if message_content:
-                messages.append({
-                    "role": content.role,
-                    "content": message_content
-                })
-
-        # Apply chat template and generate
-        config = request.generationConfig or GenerationConfig()
 
-        inputs = processor.apply_chat_template(
-            messages,
+# Placeholder used to split rendered chat templates at the first user turn
+PROMPT_SENTINEL = "<<prompt-sentinel>>"
+
+
+def _render_up_to_first_turn(state: AppState, messages: List[Dict[str, Any]]) -> str:
+    """Render the chat template and cut it just before the first user text."""
+    rendered = state.tokenizer.apply_chat_template(
+        messages + [{
+            "role": "user",
+            "content": [{"type": "text", "text": PROMPT_SENTINEL}]
+        }],
+        tokenize=False,
+    )
+    return rendered[:rendered.index(PROMPT_SENTINEL)]
+
+
+@functools.lru_cache(maxsize=1)
+def user_turn_prefix(state: AppState) -> str:
+    """Template text preceding the first user turn when there is no system prompt."""
+    return _render_up_to_first_turn(state, [])
+
+
+@functools.lru_cache(maxsize=8)
+def system_prefix_ids(state: AppState, system_text: str) -> torch.Tensor:
+    """Token ids of the template prefix carrying a system prompt."""
+    prefix = _render_up_to_first_turn(state, [{
+        "role": "system",
+        "content": [{"type": "text", "text": system_text}]
+    }])
+    return state.tokenizer(
+        prefix, add_special_tokens=False, return_tensors="pt"
+    ).input_ids
+
+
+# Tokens re-encoded on each side of the cached system prefix join
+SPLICE_WINDOW = 4
+
+
+def splice_is_exact(
+    state: AppState,
+    prefix_ids: torch.Tensor,
+    turn_ids: torch.Tensor
+) -> bool:
+    """Check that separately tokenized prefix and turns match one full encode."""
+    # Merges are local, so re-encoding the tokens around the join shows
+    # whether the full render would have merged across it (e.g. "\n\n#")
+    window = torch.cat([
+        prefix_ids[0, -SPLICE_WINDOW:], turn_ids[0, :SPLICE_WINDOW]]).tolist()
+    text = state.tokenizer.decode(window)
+    return state.tokenizer(text, add_special_tokens=False).input_ids == window
+
+
+def to_device(state: AppState, inputs):
+    """Copy tokenized inputs to the model device without blocking the host."""
+    if state.device.type == "cpu":
+        # Already where the model runs, nothing to transfer
+        return inputs
+    # The copy overlaps with the host-side generate() setup that follows
+    return inputs.to(state.device, non_blocking=True)
+
+
+def prepare_inputs(state: AppState, request: GenerateContentRequest):
+    """Build chat messages for a request and tokenize them on the host."""
+    tokenizer = state.tokenizer
+    system_text = _DEFAULT_SYSTEM_PROMPT
+    system_ids = state.system_ids
+
+    if request.systemInstruction:
+        # Use provided system instruction from the CLI
+        for part in request.systemInstruction.parts:
+            if part.text:
+                system_text = part.text
+                system_ids = None
+                break
+
+    # Convert request contents to proper message format
+    conversation = []
+    has_image = False
+    for content in request.contents:
+        message_content = []
+        for part in content.parts:
+            if part.text:
+                message_content.append({"type": "text", "text": part.text})
+            elif part.image:
+                message_content.append(
+                    {"type": "image", "image": part.image})
+                has_image = True
+
+        if message_content:
+            conversation.append({
+                "role": content.role,
+                "content": message_content
+            })
+
+    system_message = {
+        "role": "system",
+        "content": [{"type": "text", "text": system_text}]
+    }
+
+    if not has_image:
+        # Text-only requests skip the multimodal processor entirely and reuse
+        # the cached system prompt tokens, only tokenizing the turns
+        input_ids = None
+        rendered = tokenizer.apply_chat_template(
+            conversation,
             add_generation_prompt=True,
-            tokenize=True,
-            return_tensors="pt",
-            return_dict=True,
+            tokenize=False,
         )
+        prefix = user_turn_prefix(state)
+        if rendered.startswith(prefix):
+            if system_ids is None:
+                system_ids = system_prefix_ids(state, system_text)
+            turn_ids = tokenizer(
+                rendered[len(prefix):],
+                add_special_tokens=False,
+                return_tensors="pt",
+            ).input_ids
+            if splice_is_exact(state, system_ids, turn_ids):
+                input_ids = torch.cat([system_ids, turn_ids], dim=1)
+
+        if input_ids is None:
+            # Fall back to a full render when the splice would change tokens
+            input_ids = tokenizer.apply_chat_template(
+                [system_message] + conversation,
+                add_generation_prompt=True,
+                return_tensors="pt",
+            )
 
-        # Move all inputs to device
-        if device.type == "mps":
-            inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v
-                      for k, v in inputs.items()}
-
-        # Generate with the model
-        with torch.inference_mode():
-            generation_kwargs = {
-                "max_new_tokens": config.maxOutputTokens or 200,
-                "do_sample": config.temperature != 0 if config.temperature is not None else True,
-                "pad_token_id": tokenizer.pad_token_id or tokenizer.eos_token_id,
-                "eos_token_id": tokenizer.eos_token_id,
-                "use_cache": True,  # Enable KV cache
-            }
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+        }
+
+    messages = [system_message] + conversation
 
-            # Add attention mask if available
-            if "attention_mask" in inputs:
-                generation_kwargs["attention_mask"] = inputs["attention_mask"]
-
-            # Set conservative defaults to avoid numerical issues
-            temperature = config.temperature if config.temperature is not None else 1.0
-            top_p = config.topP if config.topP is not None else 0.95
-            top_k = config.topK if config.topK is not None else 50
-
-            # Clamp values to safe ranges
-            temperature = max(0.1, min(2.0, temperature))
-            top_p = max(0.1, min(1.0, top_p))
-            top_k = max(1, min(100, top_k))
-
-            if temperature > 0:
-                generation_kwargs.update({
-                    "temperature": temperature,
-                    "top_p": top_p,
-                    "top_k": top_k,
-                    "do_sample": True,
-                })
+    inputs = state.processor.apply_chat_template(
+        messages,
+        add_generation_prompt=True,
+        tokenize=True,
+        return_tensors="pt",
+        return_dict=True,
+    )
+
+    # Tensors stay on the host; generation copies them to the device under
+    # generation_lock so only one thread drives the device at a time
+    return inputs
+
+
+@functools.lru_cache(maxsize=64)
+def make_generation_config(
+    state: AppState,
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    max_new_tokens: int,
+    do_sample: bool,
+) -> HFGenerationConfig:
+    """Build a transformers GenerationConfig, cached per sampling bucket."""
+    tokenizer = state.tokenizer
+    # Start from the model's defaults, as generate() kwargs would
+    generation_config = copy.deepcopy(state.model.generation_config)
+    generation_config.update(
+        max_new_tokens=max_new_tokens,
+        do_sample=do_sample,
+        pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        use_cache=True,  # Enable KV cache
+    )
+    if do_sample:
+        generation_config.update(
+            temperature=temperature, top_p=top_p, top_k=top_k)
+    return generation_config
+
+
+def build_generation_kwargs(
+    state: AppState,
+    config: GenerationConfig,
+    inputs
+) -> Dict[str, Any]:
+    """Translate a Gemini generation config into model.generate kwargs."""
+    # Set conservative defaults to avoid numerical issues
+    temperature = config.temperature if config.temperature is not None else 1.0
+    top_p = config.topP if config.topP is not None else 0.95
+    top_k = config.topK if config.topK is not None else 50
+
+    # Clamp values to safe ranges
+    temperature = max(0.1, min(2.0, temperature))
+    top_p = max(0.1, min(1.0, top_p))
+    top_k = max(1, min(100, top_k))
+
+    # Bound the output so the up-front KV cache stays within memory and the
+    # model's position range
+    prompt_length = inputs["input_ids"].shape[1]
+    max_positions = state.model.config.get_text_config().max_position_embeddings
+    if prompt_length >= max_positions:
+        raise ValueError(
+            f"Prompt of {prompt_length} tokens exceeds the model's "
+            f"{max_positions}-token context")
+    max_new_tokens = min(
+        config.maxOutputTokens or 200, MAX_NEW_TOKENS,
+        max_positions - prompt_length)
+
+    # Quantize sampling params so repeat requests hit a cached config
+    generation_kwargs = {
+        "generation_config": make_generation_config(
+            state,
+            round(temperature, 1),
+            round(top_p, 2),
+            top_k,
+            max_new_tokens,
+            temperature > 0,
+        ),
+        # The config already carries the model defaults; without this
+        # generate() would also overwrite any value equal to a global default
+        # (e.g. topP=1.0) with the checkpoint's
+        "use_model_defaults": False,
+    }
+
+    # Add attention mask if available
+    if "attention_mask" in inputs:
+        generation_kwargs["attention_mask"] = inputs["attention_mask"]
+
+    return generation_kwargs
+
+
+def make_static_cache(
+    state: AppState,
+    batch_size: int,
+    max_cache_len: int
+) -> StaticCache:
+    """Allocate a fixed-shape KV cache so compiled decode graphs are reused."""
+    # Round up so nearby prompt lengths share the same cache shape
+    max_cache_len = -(-max_cache_len // CACHE_LENGTH_BUCKET) * CACHE_LENGTH_BUCKET
+    return StaticCache(
+        config=state.model.config.get_text_config(),
+        max_batch_size=batch_size,
+        max_cache_len=max_cache_len,
+        device=state.device,
+        dtype=state.model.dtype,
+    )
+
+
+def generation_key(generation_kwargs: Dict[str, Any]) -> tuple:
+    """Key identifying requests that can share a model.generate call."""
+    return tuple(sorted(generation_kwargs.items()))
+
+
+def generate_batch(state: AppState, batch: List[tuple]) -> List[torch.Tensor]:
+    """Run one left-padded model.generate call for a group of requests."""
+    model, tokenizer = state.model, state.tokenizer
+    pad_token_id = tokenizer.pad_token_id or tokenizer.eos_token_id
+    lengths = [input_ids.shape[1] for input_ids, _, _ in batch]
+    max_length = max(lengths)
+
+    # Pad on the host; device work happens only under generation_lock
+    input_ids = torch.full(
+        (len(batch), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for row, ((request_ids, _, _), length) in enumerate(zip(batch, lengths)):
+        input_ids[row, max_length - length:] = request_ids[0]
+        attention_mask[row, max_length - length:] = 1
+
+    generation_kwargs = batch[0][1]
+    with state.generation_lock, torch.inference_mode():
+        past_key_values = make_static_cache(
+            state,
+            len(batch),
+            max_length + generation_kwargs["generation_config"].max_new_tokens)
+        outputs = model.generate(
+            to_device(state, input_ids),
+            attention_mask=to_device(state, attention_mask),
+            past_key_values=past_key_values,
+            **generation_kwargs
+        ).cpu()
+
+    results = []
+    for row in outputs[:, max_length:]:
+        # Rows that finished early are padded out to the longest generation
+        kept = (row != pad_token_id).nonzero()
+        results.append(row[:int(kept[-1]) + 1] if len(kept) else row[:0])
+    return results
+
+
+async def batch_generation_worker(state: AppState):
+    """Coalesce concurrent generate requests into batched model.generate calls."""
+    loop = asyncio.get_running_loop()
+    generation_queue = state.generation_queue
+
+    while True:
+        pending = [await generation_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while len(pending) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(
+                    await asyncio.wait_for(generation_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Only requests with identical generation settings can be batched
+        groups: Dict[tuple, List[tuple]] = {}
+        for item in pending:
+            groups.setdefault(generation_key(item[1]), []).append(item)
+
+        for group in groups.values():
+            try:
+                results = await loop.run_in_executor(
+                    None, generate_batch, state, group)
+            except Exception as e:
+                for _, _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
             else:
-                generation_kwargs["do_sample"] = False
+                for (_, _, future), result in zip(group, results):
+                    if not future.done():
+                        future.set_result(result)
+
+
+async def submit_generation(
+    state: AppState,
+    input_ids: torch.Tensor,
+    generation_kwargs: Dict[str, Any]
+) -> torch.Tensor:
+    """Queue a request for the batching worker and wait for its tokens."""
+    future = asyncio.get_running_loop().create_future()
+    await state.generation_queue.put((input_ids, generation_kwargs, future))
+    return await future
+
+
+# Chat template role header the model sometimes repeats at the start of a reply
+ROLE_HEADER = "model\n"
+
+
+@functools.lru_cache(maxsize=1)
+def role_header_ids(state: AppState) -> tuple:
+    """Token ids of ROLE_HEADER and of the special tokens that may precede it."""
+    tokenizer = state.tokenizer
+    header_ids = tuple(tokenizer.convert_tokens_to_ids(["model", "\n"]))
+    return header_ids, frozenset(tokenizer.all_special_ids)
+
+
+def strip_role_header(state: AppState, tokens: torch.Tensor) -> torch.Tensor:
+    """Drop a leaked ROLE_HEADER from the start of generated token ids."""
+    header_ids, special_ids = role_header_ids(state)
+    start = 0
+    while start < len(tokens) and int(tokens[start]) in special_ids:
+        start += 1
+    if tuple(tokens[start:start + len(header_ids)].tolist()) == header_ids:
+        return tokens[start + len(header_ids):]
+    return tokens
+
+
+def strip_streamed_role_header(texts):
+    """Drop a leaked ROLE_HEADER from the start of a decoded text stream."""
+    texts = iter(texts)
+    head = ""
+    # Hold back text while it could still be the start of the header
+    for text in texts:
+        head += text
+        if head == ROLE_HEADER or not ROLE_HEADER.startswith(head):
+            break
+    else:
+        # Stream already ended; a TextIteratorStreamer blocks if advanced again
+        if head:
+            yield head
+        return
+    if head.startswith(ROLE_HEADER):
+        head = head[len(ROLE_HEADER):]
+    if head:
+        yield head
+    yield from texts
 
-            outputs = model.generate(
-                inputs["input_ids"],
-                **generation_kwargs
-            )
+
+@app.post("/v1/models/{model_name}:generateContent")
+async def generate_content(
+    model_name: str,
+    request: GenerateContentRequest,
+    state: AppState = Depends(get_app_state)
+) -> GenerateContentResponse:
+    """Generate content using the local model."""
+    tokenizer = state.tokenizer
+
+    try:
+        inputs = prepare_inputs(state, request)
+        config = request.generationConfig or GenerationConfig()
+
+        generation_kwargs = build_generation_kwargs(state, config, inputs)
+        # The batching worker builds a padded mask for the whole batch
+        generation_kwargs.pop("attention_mask", None)
+
+        # Generate with the model, sharing a batch with concurrent requests
+        generated_tokens = await submit_generation(
+            state, inputs["input_ids"], generation_kwargs)
 
         # Decode only the generated tokens (not the input)
         input_length = inputs["input_ids"].shape[1]
-        generated_tokens = outputs[0][input_length:]
-        response_text = processor.decode(
-            generated_tokens, skip_special_tokens=True)
 
-        # Clean up the response
-        response_text = response_text.strip()
+        # Drop a leaked chat template role header before decoding rather
+        # than scanning the decoded string for it
+        generated_tokens = strip_role_header(state, generated_tokens)
 
-        # Remove any remaining chat template artifacts
-        if response_text.startswith("model\n"):
-            response_text = response_text[6:].strip()
-        if response_text.startswith("\n"):
-            response_text = response_text.strip()
+        response_text = tokenizer.decode(
+            generated_tokens,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
+        ).strip()
 
         # Create response in Gemini API format
         response_content = Content(
@@ -381,9 +988,9 @@ async def generate_content(
             index=0
         )
 
-        # More accurate token counting
-        prompt_tokens = len(tokenizer.encode(str(request.contents)))
-        response_tokens = len(tokenizer.encode(response_text))
+        # Reuse the lengths we already have instead of re-tokenizing
+        prompt_tokens = int(input_length)
+        response_tokens = int(generated_tokens.shape[0])
 
         usage = UsageMetadata(
             promptTokenCount=prompt_tokens,
@@ -404,52 +1011,117 @@ async def generate_content(
 @app.post("/v1/models/{model_name}:streamGenerateContent")
 async def stream_generate_content(
     model_name: str,
-    request: GenerateContentRequest
+    request: GenerateContentRequest,
+    state: AppState = Depends(get_app_state)
 ):
-    """Stream content generation (simplified implementation)."""
-    # For now, we'll return the full response as a single chunk
-    # A proper streaming implementation would generate tokens incrementally
-    response = await generate_content(model_name, request)
-
-    async def generate_stream():
-        # Return as a single chunk for simplicity
-        chunk = {
+    """Stream content generation token by token."""
+    try:
+        inputs = prepare_inputs(state, request)
+        config = request.generationConfig or GenerationConfig()
+        generation_kwargs = build_generation_kwargs(state, config, inputs)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Generation failed: {str(e)}")
+
+    streamer = TextIteratorStreamer(
+        state.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def run_generation():
+        try:
+            with state.generation_lock, torch.inference_mode():
+                past_key_values = make_static_cache(
+                    state,
+                    1,
+                    inputs["input_ids"].shape[1]
+                    + generation_kwargs["generation_config"].max_new_tokens)
+                if "attention_mask" in generation_kwargs:
+                    generation_kwargs["attention_mask"] = to_device(
+                        state, generation_kwargs["attention_mask"])
+                state.model.generate(
+                    to_device(state, inputs["input_ids"]),
+                    streamer=streamer,
+                    past_key_values=past_key_values,
+                    **generation_kwargs
+                )
+        except Exception as e:
+            # Unblock the consumer and let it report the failure
+            errors.append(e)
+            streamer.end()
+
+    # Run generation in the background and emit text as it is decoded
+    threading.Thread(target=run_generation, daemon=True).start()
+
+    def generate_stream():
+        for text in strip_streamed_role_header(streamer):
+            if not text:
+                continue
+            chunk = {
+                "candidates": [
+                    {"content": {"role": "model", "parts": [{"text": text}]}}
+                ]
+            }
+            yield b"data: " + orjson.dumps(chunk) + b"\n\n"
+
+        if errors:
+            error_chunk = {
+                "error": {
+                    "code": 500,
+                    "message": f"Generation failed: {str(errors[0])}",
+                    "status": "INTERNAL"
+                }
+            }
+            yield b"data: " + orjson.dumps(error_chunk) + b"\n\n"
+            return
+
+        final_chunk = {
             "candidates": [
                 {
-                    "content": {
-                        "parts": response.candidates[0].content.parts[0].model_dump()
-                    },
-                    "finishReason": response.candidates[0].finishReason
+                    "content": {"role": "model", "parts": [{"text": ""}]},
+                    "finishReason": "STOP"
                 }
             ]
         }
-        yield f"data: {chunk}\n\n"
-        yield "data: [DONE]\n\n"
+        yield b"data: " + orjson.dumps(final_chunk) + b"\n\n"
+        yield b"data: [DONE]\n\n"
 
     return StreamingResponse(
         generate_stream(),
-        media_type="text/plain"
+        media_type="text/event-stream"
     )
 
 
 @app.post("/v1/models/{model_name}:countTokens")
 async def count_tokens(
     model_name: str,
-    request: CountTokensRequest
+    request: CountTokensRequest,
+    state: AppState = Depends(get_app_state)
 ) -> CountTokensResponse:
     """Count tokens in the provided content."""
-    total_tokens = 0
+    texts = [part.text
+             for content in request.contents
+             for part in content.parts
+             if part.text]
 
-    for content in request.contents:
-        for part in content.parts:
-            if part.text:
-                # Use actual tokenizer for accurate count
-                total_tokens += len(tokenizer.encode(part.text))
+    total_tokens = 0
+    if texts:
+        # Encode all parts in a single batched tokenizer call
+        lengths = state.tokenizer(
+            texts, add_special_tokens=False, return_length=True)["length"]
+        total_tokens = sum(lengths)
 
     return CountTokensResponse(totalTokens=total_tokens)
 
 
-@app.post("/v1/models/{model_name}:embedContent")
+# Dummy embedding vector of 768 dimensions (common size)
+EMBEDDING_DIM = 768
+_ZERO_EMB = np.zeros(EMBEDDING_DIM, dtype="<f4")
+_ZERO_EMB_B64 = base64.b64encode(_ZERO_EMB.tobytes()).decode("ascii")
+# Shared read-only across requests instead of allocating a list per input
+_ZERO_EMB_LIST = _ZERO_EMB.tolist()
+
+
+@app.post("/v1/models/{model_name}:embedContent", response_model_exclude_none=True)
 async def embed_content(
     model_name: str,
     request: EmbedContentRequest
@@ -457,12 +1129,15 @@ async def embed_content(
     """Generate embeddings (placeholder implementation)."""
     # This is a placeholder - Gemma 3n E4B is not primarily an embedding model
     # You might want to use a different model for embeddings or return dummy values
-    embeddings = []
+    # A real embedding model should embed all inputs as one (N, dim) batch
+    # and copy it to the host once, rather than running per-input forwards
+    if request.encodingFormat == "base64":
+        # Packed float32 bytes are ~4x smaller than a JSON float list
+        embedding = Embedding(values_b64=_ZERO_EMB_B64)
+    else:
+        embedding = Embedding(values=_ZERO_EMB_LIST)
 
-    for text in request.contents:
-        # Return dummy embedding vector of 768 dimensions (common size)
-        dummy_embedding = [0.0] * 768
-        embeddings.append(Embedding(values=dummy_embedding))
+    embeddings = [embedding] * len(request.contents)
 
     return EmbedContentResponse(embeddings=embeddings)
 
@@ -495,8 +1170,11 @@ if __name__ == "__main__":
 
     print(f"🚀 Starting Gemma 3n E4B server on http://{args.host}:{args.port}")
 
-    # Set optimal number of threads for M2
-    torch.set_num_threads(8)
+    # Size the intra-op pool to the machine, leaving a core for the server
+    torch.set_num_threads(max(1, (os.cpu_count() or 4) - 1))
+    if not torch.backends.mps.is_available():
+        # CPU fallback parallelises inside ops; extra inter-op threads contend
+        torch.set_num_interop_threads(1)
 
     uvicorn.run(
         "gemma_server:app",
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Smoke tests for the Gemma 3n server helpers on a tiny random Gemma3n model.
+Run with: python -m pytest test_gemma_server.py
+"""
+
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("timm")  # Gemma3n builds a timm vision tower
+transformers = pytest.importorskip("transformers")
+
+import gemma_server  # noqa: E402
+
+NUM_LAYERS = 4
+
+
+def make_tiny_model(dtype=torch.float32):
+    """Build a randomly initialised Gemma3n small enough to run on CPU."""
+    text_config = transformers.Gemma3nTextConfig(
+        vocab_size=300,
+        vocab_size_per_layer_input=300,
+        hidden_size=64,
+        hidden_size_per_layer_input=32,
+        intermediate_size=[128] * NUM_LAYERS,
+        num_hidden_layers=NUM_LAYERS,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        head_dim=32,
+        layer_types=["sliding_attention"] * 3 + ["full_attention"],
+        sliding_window=16,
+        num_kv_shared_layers=0,
+        activation_sparsity_pattern=[0.0] * NUM_LAYERS,
+        laurel_rank=32,
+        max_position_embeddings=512,
+        pad_token_id=0,
+        eos_token_id=1,
+        bos_token_id=2,
+    )
+    config = transformers.Gemma3nConfig(text_config=text_config.to_dict())
+    torch.manual_seed(0)
+    return transformers.Gemma3nForConditionalGeneration(config).to(dtype).eval()
+
+
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float16])
+@pytest.mark.parametrize("linear_cls", [
+    gemma_server.Int8WeightOnlyLinear,
+    gemma_server.Float8WeightOnlyLinear,
+])
+def test_quantized_model_generates(linear_cls, dtype):
+    model = make_tiny_model(dtype)
+    count = gemma_server.quantize_linear_layers(model, linear_cls)
+    assert count > 0
+
+    for name, module in model.named_modules():
+        if name.rsplit(".", 1)[-1] in gemma_server.UNQUANTIZED_LINEARS:
+            assert isinstance(module, torch.nn.Linear)
+
+    input_ids = torch.randint(3, 300, (1, 8))
+    with torch.inference_mode():
+        outputs = model.generate(input_ids, max_new_tokens=4, do_sample=False)
+    assert outputs.shape[1] > input_ids.shape[1]
+
+
+@pytest.mark.parametrize("in_features", [8, 24, 64])
+def test_int8_linear_matches_float(in_features):
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(in_features, 48).to(torch.bfloat16)
+    quantized = gemma_server.Int8WeightOnlyLinear(linear)
+    x = torch.randn(5, in_features, dtype=torch.bfloat16)
+    expected = linear(x).float()
+    error = (quantized(x).float() - expected).abs().max()
+    assert error <= 0.05 * expected.abs().max()
+
+
+def make_tiny_state(model=None, tokenizer=None):
+    return gemma_server.AppState(
+        model=model, processor=None, tokenizer=tokenizer,
+        device=torch.device("cpu"))
+
+
+@pytest.mark.parametrize("prompt_length, max_output_tokens, expected", [
+    (8, 100, 100),
+    (8, 65536, 504),
+    (500, 100, 12),
+])
+def test_max_new_tokens_is_bounded(
+        monkeypatch, prompt_length, max_output_tokens, expected):
+    monkeypatch.setattr(gemma_server, "MAX_NEW_TOKENS", 1024)
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=1)
+    model = types.SimpleNamespace(
+        config=transformers.Gemma3nTextConfig(max_position_embeddings=512),
+        generation_config=transformers.GenerationConfig())
+    state = make_tiny_state(model, tokenizer)
+    input_ids = torch.ones(1, prompt_length, dtype=torch.long)
+    generation_kwargs = gemma_server.build_generation_kwargs(
+        state,
+        gemma_server.GenerationConfig(maxOutputTokens=max_output_tokens),
+        {"input_ids": input_ids},
+    )
+    assert generation_kwargs["generation_config"].max_new_tokens == expected
+
+
+def test_requested_sampling_overrides_model_defaults():
+    model = transformers.LlamaForCausalLM(transformers.LlamaConfig(
+        vocab_size=32, hidden_size=32, intermediate_size=64,
+        num_hidden_layers=1, num_attention_heads=2, max_position_embeddings=64))
+    # Gemma 3n checkpoint defaults
+    model.generation_config.update(do_sample=True, top_k=64, top_p=0.95)
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=1)
+    state = make_tiny_state(model, tokenizer)
+
+    generation_kwargs = gemma_server.build_generation_kwargs(
+        state,
+        gemma_server.GenerationConfig(
+            temperature=0.7, topP=1.0, topK=50, maxOutputTokens=16),
+        {"input_ids": torch.ones(1, 8, dtype=torch.long)},
+    )
+    generation_config, _ = model._prepare_generation_config(**generation_kwargs)
+    assert generation_config.temperature == 0.7
+    assert generation_config.top_p == 1.0
+    assert generation_config.top_k == 50
+    assert generation_config.max_new_tokens == 16
+
+
+class HeaderTokenizer:
+    """Just enough tokenizer for the role header helpers."""
+    all_special_ids = [0, 1, 2]
+
+    def convert_tokens_to_ids(self, tokens):
+        return [{"model": 5, "\n": 6}[token] for token in tokens]
+
+
+@pytest.mark.parametrize("tokens, expected", [
+    ([5, 6, 7, 8], [7, 8]),
+    ([2, 5, 6, 7], [7]),
+    ([5, 7, 8], [5, 7, 8]),
+    ([7, 5, 6], [7, 5, 6]),
+    ([5], [5]),
+])
+def test_strip_role_header(tokens, expected):
+    state = make_tiny_state(tokenizer=HeaderTokenizer())
+    stripped = gemma_server.strip_role_header(state, torch.tensor(tokens))
+    assert stripped.tolist() == expected
+
+
+class StreamerLike:
+    """Iterator that, like TextIteratorStreamer, must not be advanced after ending."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.ended = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        assert not self.ended, "advanced after the stream ended"
+        if not self.chunks:
+            self.ended = True
+            raise StopIteration
+        return self.chunks.pop(0)
+
+
+@pytest.mark.parametrize("chunks, expected", [
+    (["model", "\n", "Hello", " there"], "Hello there"),
+    (["mod", "el\nHi"], "Hi"),
+    (["model", "ling clay"], "modelling clay"),
+    (["mod"], "mod"),
+    (["Hi ", "model\n"], "Hi model\n"),
+])
+def test_strip_streamed_role_header(chunks, expected):
+    assert "".join(gemma_server.strip_streamed_role_header(
+        StreamerLike(chunks))) == expected
+
+
+
+# Gemma 3 chat template: the system prompt is folded into the first user turn
+GEMMA_CHAT_TEMPLATE = (
+    "{{ bos_token }}"
+    "{%- if messages[0]['role'] == 'system' -%}"
+    "{%- set first_user_prefix = messages[0]['content'][0]['text'] + '\\n\\n' -%}"
+    "{%- set loop_messages = messages[1:] -%}"
+    "{%- else -%}"
+    "{%- set first_user_prefix = '' -%}"
+    "{%- set loop_messages = messages -%}"
+    "{%- endif -%}"
+    "{%- for message in loop_messages -%}"
+    "{%- set role = 'model' if message['role'] == 'assistant' else message['role'] -%}"
+    "{{ '<start_of_turn>' + role + '\\n' + (first_user_prefix if loop.first else '') }}"
+    "{%- for item in message['content'] -%}"
+    "{%- if item['type'] == 'text' -%}{{ item['text'] | trim }}{%- endif -%}"
+    "{%- endfor -%}"
+    "{{ '<end_of_turn>\\n' }}"
+    "{%- endfor -%}"
+    "{%- if add_generation_prompt -%}{{ '<start_of_turn>model\\n' }}{%- endif -%}"
+)
+
+
+def make_chat_tokenizer():
+    """Train a small SentencePiece-style BPE (no pre-tokenizer, so merges may
+    cross whitespace the way Gemma's do) and attach the Gemma chat template."""
+    tokenizers = pytest.importorskip("tokenizers")
+    special_tokens = ["<pad>", "<eos>", "<bos>", "<unk>",
+                      "<start_of_turn>", "<end_of_turn>"]
+    backend = tokenizers.Tokenizer(tokenizers.models.BPE(unk_token="<unk>"))
+    backend.normalizer = tokenizers.normalizers.Replace(" ", "\u2581")
+    backend.decoder = tokenizers.decoders.Replace("\u2581", " ")
+    corpus = [gemma_server._DEFAULT_SYSTEM_PROMPT,
+              "Hello there!\n\n# Notes\n\n```python\nprint(1)\n```\n"]
+    backend.train_from_iterator(corpus, tokenizers.trainers.BpeTrainer(
+        vocab_size=800,
+        special_tokens=special_tokens,
+        initial_alphabet=[chr(c) for c in range(32, 127)] + ["\n", "\u2581"],
+    ))
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        pad_token="<pad>", eos_token="<eos>", bos_token="<bos>",
+        unk_token="<unk>",
+        additional_special_tokens=special_tokens[4:],
+    )
+    tokenizer.chat_template = GEMMA_CHAT_TEMPLATE
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def chat_state():
+    state = make_tiny_state(tokenizer=make_chat_tokenizer())
+    state.system_ids = gemma_server.system_prefix_ids(
+        state, gemma_server._DEFAULT_SYSTEM_PROMPT)
+    return state
+
+
+@pytest.mark.parametrize("turns", [
+    [("user", "Hello")],
+    [("user", "# Notes on the build")],
+    [("user", "```python\nprint(1)\n```")],
+    [("user", "Hi"), ("model", "Hello there!"), ("user", "\n\nAnd now?")],
+])
+@pytest.mark.parametrize("system_text", [None, "Be brief.\n"])
+def test_cached_prefix_matches_full_render(chat_state, turns, system_text):
+    request = gemma_server.GenerateContentRequest(contents=[
+        gemma_server.Content(role=role, parts=[gemma_server.Part(text=text)])
+        for role, text in turns
+    ])
+    if system_text is not None:
+        request.systemInstruction = gemma_server.Content(
+            role="user", parts=[gemma_server.Part(text=system_text)])
+
+    input_ids = gemma_server.prepare_inputs(chat_state, request)["input_ids"]
+
+    messages = [{
+        "role": "system",
+        "content": [{"type": "text",
+                     "text": system_text or gemma_server._DEFAULT_SYSTEM_PROMPT}],
+    }] + [
+        {"role": role, "content": [{"type": "text", "text": text}]}
+        for role, text in turns
+    ]
+    expected = chat_state.tokenizer.apply_chat_template(
+        messages, add_generation_prompt=True, return_tensors="pt")
+    assert input_ids.tolist() == expected.tolist()